@@ -7,8 +7,11 @@ import time
 import os
 import json
 from payment_handler import init_stripe, display_subscription_plans, handle_subscription_status
+from snapshot_store import SnapshotStore
+from usage_tracker import get_usage_tracker
 from dotenv import load_dotenv
 import re
+from concurrent.futures import ThreadPoolExecutor
 
 # 加载环境变量
 load_dotenv()
@@ -19,11 +22,22 @@ logging.basicConfig(level=logging.INFO, format="%(asctime)s - %(levelname)s - %(
 # API 配置
 API_BASE_URL = os.getenv('API_BASE_URL', 'https://f166-156-225-26-202.ngrok-free.app')
 LOCAL_BRANDS_MODELS_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), "brands_models.json")
+LOCAL_SNAPSHOT_DB = os.path.join(os.path.dirname(os.path.abspath(__file__)), "trend_snapshots.db")
+FREE_QUERY_LIMIT = 5
+CROSS_MODEL_FETCH_LIMIT = 4
 
 # 初始化 Stripe
 stripe_config = init_stripe()
 
 
+@st.cache_resource
+def get_snapshot_store():
+    return SnapshotStore(f"sqlite:///{LOCAL_SNAPSHOT_DB}")
+
+
+snapshot_store = get_snapshot_store()
+
+
 # 验证邮箱格式的函数
 def is_valid_email(email):
     pattern = r'^[a-zA-Z0-9._%+-]+@[a-zA-Z0-9.-]+\.[a-zA-Z]{2,}$'
@@ -75,7 +89,7 @@ def login_user(email, password):
             st.session_state['query_count'] = data['query_count']
             st.success(f"登录成功！订阅状态：{data['subscription_status']}")
             if data['subscription_status'] == "free":
-                st.info(f"免费版剩余查询次数：{5 - data['query_count']}")
+                st.info(f"免费版剩余查询次数：{FREE_QUERY_LIMIT - data['query_count']}")
             return True
         else:
             st.error('邮箱或密码错误')
@@ -122,18 +136,105 @@ def load_brands_models_from_local():
     return ["Zeekr", "BYD"], {"Zeekr": ["7X", "001", "全车型"], "BYD": ["Han", "Song", "全车型"]}
 
 
-def fetch_data(country, brand, model, data_type, trend, email):
+def fetch_trend_from_api(country, brand, model, data_type, trend, start_date=None):
+    url = f"{API_BASE_URL}/api/trend?country={country}&brand={brand}&model={model}&data_type={data_type}&type={trend}"
+    if start_date:
+        url += f"&start_date={start_date.isoformat()}"
+    try:
+        response = requests.get(url, timeout=5)
+        if response.status_code == 200:
+            return response.json()["data"]
+    except requests.RequestException as e:
+        logging.error(f"Failed to fetch trend: {e}")
+        return {"x": ["网络错误"], "y": [0]}
+    return {"x": ["请求错误"], "y": [0]}
+
+
+def get_client_ip():
+    try:
+        from streamlit.web.server.websocket_headers import _get_websocket_headers
+        headers = _get_websocket_headers() or {}
+        forwarded = headers.get("X-Forwarded-For")
+        if forwarded:
+            return forwarded.split(",")[0].strip()
+        return headers.get("X-Real-Ip")
+    except Exception as e:
+        logging.warning(f"Failed to get client ip: {e}")
+        return None
+
+
+def local_quota_exceeded(email):
+    # 在请求远程 /api/query 之前检查，已知超额的免费用户不再占用远程计数
+    if st.session_state.get('subscription_status') != "free":
+        return False
+    used = max(get_usage_tracker().get_usage_count(email), st.session_state.get('query_count', 0))
+    return used >= FREE_QUERY_LIMIT
+
+
+def record_query(email):
+    # 远程允许后记录；查询次数和IP先在内存中累计，由 usage_tracker 批量写入 users 表
+    get_usage_tracker().record_query(email, get_client_ip())
+    st.session_state['query_count'] = st.session_state.get('query_count', 0) + 1
+    if st.session_state.get('subscription_status') == "free":
+        st.info(f"免费版剩余查询次数：{max(FREE_QUERY_LIMIT - st.session_state['query_count'], 0)}")
+
+
+def fetch_history(country, brand, model, data_type, trend, show_rolling=False, show_wow=False,
+                  show_percentiles=False):
+    # 历史数据从本地快照读取，只向远程补抓缺少的天数
+    if trend.startswith("跨车型对比"):
+        return fetch_cross_model(country, brand, data_type, trend.replace("跨车型对比", "车型", 1))
+
+    data = snapshot_store.get_or_fetch(
+        country, brand, model, trend,
+        lambda start_date: fetch_trend_from_api(country, brand, model, data_type, trend, start_date))
+    # 以下统计只在图表需要显示时计算，且只用于本地序列
+    if show_rolling:
+        rolling = snapshot_store.rolling_average(country, brand, model, trend, window=7)
+        if rolling["x"] == data["x"]:
+            data["rolling"] = rolling["rolling"]
+    if show_wow:
+        wow = snapshot_store.week_over_week(country, brand, model, trend)
+        if wow["x"] == data["x"]:
+            data["wow_pct"] = wow["pct"]
+    if show_percentiles and "平均价格" in trend:
+        data["percentiles"] = snapshot_store.price_percentiles(country, brand, model, trend=trend)
+    return data
+
+
+def fetch_cross_model(country, brand, data_type, base_trend):
+    models = [m for m in st.session_state['models'].get(brand, []) if m != "全车型"]
+    stale = {}
+    for m in models:
+        since = snapshot_store.missing_since(country, brand, m, base_trend)
+        if since is not False:
+            stale[m] = since
+    # 每次最多并发补抓 CROSS_MODEL_FETCH_LIMIT 个车型，其余下次查询时补抓
+    batch = list(stale.items())[:CROSS_MODEL_FETCH_LIMIT]
+    if batch:
+        with ThreadPoolExecutor(max_workers=len(batch)) as pool:
+            results = list(pool.map(
+                lambda item: fetch_trend_from_api(country, brand, item[0], data_type, base_trend, item[1]), batch))
+        for (m, _), result in zip(batch, results):
+            snapshot_store.store_remote(country, brand, m, base_trend, result)
+    return {"series": snapshot_store.compare_models(country, brand, base_trend, models),
+            "pending_models": len(stale) - len(batch)}
+
+
+def fetch_data(country, brand, model, data_type, trend, email, show_rolling=False, show_wow=False,
+               show_percentiles=False):
+    if local_quota_exceeded(email):
+        st.error("免费用户查询次数已达上限，请升级到高级版")
+        return None
     payload = {"email": email}
     try:
         response = requests.post(f"{API_BASE_URL}/api/query", json=payload, timeout=5)
         if response.status_code == 200 and response.json().get("allow"):
-            url = f"{API_BASE_URL}/api/trend?country={country}&brand={brand}&model={model}&data_type={data_type}&type={trend}"
-            response = requests.get(url, timeout=5)
-            if response.status_code == 200:
-                data = response.json()["data"]
-                return data
-            else:
-                return {"x": ["请求错误"], "y": [0]}
+            record_query(email)
+            if data_type == "历史回溯":
+                return fetch_history(country, brand, model, data_type, trend, show_rolling, show_wow,
+                                     show_percentiles)
+            return fetch_trend_from_api(country, brand, model, data_type, trend)
         else:
             st.error("免费用户查询次数已达上限，请升级到高级版")
             return None
@@ -260,10 +361,18 @@ else:
                 trend_options = ["车型-每日总广告量-时间", "车型-平均价格-时间"]
                 if country == "哈萨克KOLESA":
                     trend_options.append("车型-每日总观看量-时间")
+                trend_options.append("跨车型对比-平均价格-时间")
         trend = st.selectbox("图表类型", trend_options, key="trend")
+        show_rolling = show_wow = show_percentiles = False
+        if data_type == "历史回溯" and not trend.startswith("跨车型对比"):
+            show_rolling = st.checkbox("显示7日均线", value=True, key="show_rolling")
+            show_wow = st.checkbox("显示周环比", key="show_wow")
+            if "平均价格" in trend:
+                show_percentiles = st.checkbox("显示价格分位数", key="show_percentiles")
 
         if st.button("生成图表"):
-            data = fetch_data(country, brand, model, data_type, trend, st.session_state['user_email'])
+            data = fetch_data(country, brand, model, data_type, trend, st.session_state['user_email'],
+                              show_rolling, show_wow, show_percentiles)
             if data:
                 fig = go.Figure()
                 if "价格区间-广告量" in trend:
@@ -279,8 +388,25 @@ else:
                         fig.add_vline(x=data["median_price"], line_dash="dash", line_color="green",
                                       annotation_text="中位数价格")
                     fig.update_layout(xaxis_title="价格", yaxis_title="观看量")
+                elif "series" in data:
+                    for m, series in data["series"].items():
+                        fig.add_trace(go.Scatter(x=series["x"], y=series["y"], mode="lines+markers", name=m))
+                    fig.update_layout(xaxis_title="时间", yaxis_title=trend.split("-")[1])
+                    if data["pending_models"]:
+                        st.info(f"还有 {data['pending_models']} 个车型的数据尚未更新，下次查询时补充")
                 else:
                     fig.add_trace(go.Scatter(x=data["x"], y=data["y"], mode="lines+markers", name=trend.split("-")[1]))
+                    if data.get("rolling"):
+                        fig.add_trace(go.Scatter(x=data["x"], y=data["rolling"], mode="lines", name="7日均线",
+                                                 line=dict(dash="dash")))
+                    if data.get("wow_pct"):
+                        fig.add_trace(go.Bar(x=data["x"], y=data["wow_pct"], name="周环比(%)", yaxis="y2", opacity=0.4))
+                        fig.update_layout(yaxis2=dict(title="周环比(%)", overlaying="y", side="right"))
+                    for p, value in data.get("percentiles", {}).items():
+                        fig.add_hline(y=value, line_dash="dot", line_color="gray", annotation_text=f"P{p}")
                     fig.update_layout(xaxis_title="时间", yaxis_title=trend.split("-")[1])
-                fig.update_layout(title=f"{trend} ({country} - {brand} {model})")
+                if "series" in data:
+                    fig.update_layout(title=f"{trend} ({country} - {brand})")
+                else:
+                    fig.update_layout(title=f"{trend} ({country} - {brand} {model})")
                 st.plotly_chart(fig)
\ No newline at end of file
@@ -0,0 +1,114 @@
+import argparse
+import os
+import tempfile
+import threading
+import time
+from datetime import datetime
+from sqlalchemy import create_engine, select
+from sqlalchemy.orm import sessionmaker
+from models import Base, User
+from usage_tracker import UsageTracker
+
+
+# 对比两种计数方式的吞吐量：
+#   per-request: 每次查询读取次数 -> UPDATE usage_count = usage_count + 1 -> commit
+#   write-behind: UsageTracker 在内存中累计，定期批量写库
+# 用法: python bench_usage_tracker.py --threads 8 --seconds 5 --users 50
+
+
+def make_session_factory(db_path):
+    engine = create_engine(f'sqlite:///{db_path}', connect_args={'check_same_thread': False, 'timeout': 30})
+    Base.metadata.create_all(engine)
+    return engine, sessionmaker(bind=engine)
+
+
+def seed_users(session_factory, user_count):
+    db_session = session_factory()
+    try:
+        for i in range(user_count):
+            db_session.add(User(username=f'user{i}', email=f'user{i}@example.com',
+                                company_name='bench', password='x', usage_count=0))
+        db_session.commit()
+    finally:
+        db_session.close()
+
+
+def total_usage(session_factory):
+    db_session = session_factory()
+    try:
+        return sum(u.usage_count for u in db_session.query(User).all())
+    finally:
+        db_session.close()
+
+
+def per_request_query(session_factory, email, ip):
+    # 读取次数做额度检查，再用原子 UPDATE 计数，避免读-改-写丢失更新
+    db_session = session_factory()
+    try:
+        db_session.execute(
+            select(User.__table__.c.usage_count).where(User.__table__.c.email == email)
+        ).scalar()
+        db_session.execute(
+            User.__table__.update()
+            .where(User.__table__.c.email == email)
+            .values(usage_count=User.__table__.c.usage_count + 1, last_used_ip=ip,
+                    updated_at=datetime.utcnow())
+        )
+        db_session.commit()
+    except Exception:
+        db_session.rollback()
+        raise
+    finally:
+        db_session.close()
+
+
+def run(worker, threads, seconds, user_count):
+    counts = [0] * threads
+    deadline = time.perf_counter() + seconds
+
+    def loop(idx):
+        n = 0
+        while time.perf_counter() < deadline:
+            worker(f'user{(idx + n) % user_count}@example.com', f'10.0.0.{idx}')
+            n += 1
+        counts[idx] = n
+
+    workers = [threading.Thread(target=loop, args=(i,)) for i in range(threads)]
+    start = time.perf_counter()
+    for t in workers:
+        t.start()
+    for t in workers:
+        t.join()
+    return sum(counts), time.perf_counter() - start
+
+
+def main():
+    parser = argparse.ArgumentParser(description='usage_count 写入吞吐量对比')
+    parser.add_argument('--threads', type=int, default=8)
+    parser.add_argument('--seconds', type=float, default=5.0)
+    parser.add_argument('--users', type=int, default=50)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        engine, session_factory = make_session_factory(os.path.join(tmp, 'per_request.db'))
+        seed_users(session_factory, args.users)
+        done, elapsed = run(lambda email, ip: per_request_query(session_factory, email, ip),
+                            args.threads, args.seconds, args.users)
+        persisted = total_usage(session_factory)
+        engine.dispose()
+        print(f"per-request commit: {done / elapsed:10.0f} queries/sec  "
+              f"({done} queries, {persisted} persisted, {done - persisted} lost)")
+
+        engine, session_factory = make_session_factory(os.path.join(tmp, 'write_behind.db'))
+        seed_users(session_factory, args.users)
+        tracker = UsageTracker(session_factory=session_factory)
+        done, elapsed = run(tracker.record_query, args.threads, args.seconds, args.users)
+        tracker.close()
+        persisted = total_usage(session_factory)
+        engine.dispose()
+        print(f"write-behind:       {done / elapsed:10.0f} queries/sec  "
+              f"({done} queries, {persisted} persisted, {done - persisted} lost)")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,287 @@
+import logging
+import statistics
+import time
+from datetime import date, datetime, timedelta
+from sqlalchemy import create_engine, Column, Integer, String, Float, Date, DateTime, Index, UniqueConstraint, text, bindparam
+from sqlalchemy.dialects.sqlite import insert
+from sqlalchemy.orm import declarative_base
+from sqlalchemy.orm import sessionmaker
+
+# 配置日志
+logging.basicConfig(level=logging.INFO, format="%(asctime)s - %(levelname)s - %(message)s")
+
+Base = declarative_base()
+
+# 同一序列在这段时间内不重复请求远程接口（当日数据可能尚未生成、远程数据延迟或请求失败）
+REFETCH_INTERVAL = timedelta(hours=1)
+# 本地还没有任何数据的序列，请求失败后较快重试
+RETRY_INTERVAL = timedelta(minutes=5)
+
+
+class TrendSnapshot(Base):
+    """历史趋势数据，每个 (国家, 品牌, 车型, 图表类型, 日期) 一行"""
+    __tablename__ = 'trend_snapshots'
+
+    id = Column(Integer, primary_key=True)
+    country = Column(String(50), nullable=False)
+    brand = Column(String(100), nullable=False)
+    model = Column(String(100), nullable=False)
+    trend = Column(String(100), nullable=False)
+    date = Column(Date, nullable=False)
+    value = Column(Float, nullable=True)
+    fetched_at = Column(DateTime, default=datetime.utcnow)
+
+    __table_args__ = (
+        UniqueConstraint('country', 'brand', 'model', 'trend', 'date', name='uq_trend_snapshot'),
+        # 跨车型查询：同一国家、图表类型下按日期扫描
+        Index('ix_trend_snapshot_cross_model', 'country', 'trend', 'date'),
+    )
+
+
+class TrendSeries(Base):
+    """每个序列最后一次请求远程接口的时间，无论是否成功"""
+    __tablename__ = 'trend_series'
+
+    id = Column(Integer, primary_key=True)
+    country = Column(String(50), nullable=False)
+    brand = Column(String(100), nullable=False)
+    model = Column(String(100), nullable=False)
+    trend = Column(String(100), nullable=False)
+    last_fetched_at = Column(DateTime, nullable=False)
+
+    __table_args__ = (
+        UniqueConstraint('country', 'brand', 'model', 'trend', name='uq_trend_series'),
+    )
+
+
+def _parse_day(x):
+    """接口返回的日期可能带时间部分，只保留日期"""
+    return date.fromisoformat(str(x)[:10])
+
+
+class SnapshotStore:
+    def __init__(self, database_url='sqlite:///trend_snapshots.db'):
+        self.engine = create_engine(database_url, connect_args={'check_same_thread': False})
+        Base.metadata.create_all(self.engine)
+        self.Session = sessionmaker(bind=self.engine)
+
+    def get_series(self, country, brand, model, trend, start=None, end=None):
+        """读取本地序列，返回与 /api/trend 相同的 {"x": [...], "y": [...]} 结构"""
+        started = time.perf_counter()
+        sql = """
+            SELECT date, value FROM trend_snapshots
+            WHERE country = :country AND brand = :brand AND model = :model AND trend = :trend
+              AND (:start IS NULL OR date >= :start) AND (:end IS NULL OR date <= :end)
+            ORDER BY date
+        """
+        with self.engine.connect() as conn:
+            rows = conn.execute(text(sql), {
+                'country': country, 'brand': brand, 'model': model, 'trend': trend,
+                'start': start.isoformat() if start else None,
+                'end': end.isoformat() if end else None,
+            }).all()
+        logging.info(f"Local trend read: {country}-{brand}-{model}-{trend}, "
+                     f"{len(rows)} days in {(time.perf_counter() - started) * 1000:.1f} ms")
+        return {"x": [str(r.date) for r in rows], "y": [r.value for r in rows]}
+
+    def missing_since(self, country, brand, model, trend):
+        """返回需要补抓的起始日期；本地已覆盖到昨天或刚请求过时返回 False，空序列返回 None
+
+        本地只保存今天之前的完整日期，所以最后一天 >= 昨天即表示已覆盖。
+        """
+        db_session = self.Session()
+        try:
+            last_day = db_session.execute(text(
+                "SELECT MAX(date) FROM trend_snapshots "
+                "WHERE country = :country AND brand = :brand AND model = :model AND trend = :trend"
+            ), {'country': country, 'brand': brand, 'model': model, 'trend': trend}).scalar()
+            series = db_session.query(TrendSeries).filter_by(
+                country=country, brand=brand, model=model, trend=trend).first()
+        finally:
+            db_session.close()
+
+        if series:
+            interval = RETRY_INTERVAL if last_day is None else REFETCH_INTERVAL
+            if datetime.utcnow() - series.last_fetched_at < interval:
+                return False
+        if last_day is None:
+            return None
+        last_day = _parse_day(last_day)
+        if last_day >= date.today() - timedelta(days=1):
+            return False
+        return last_day + timedelta(days=1)
+
+    def record_fetch(self, country, brand, model, trend):
+        """记录一次远程请求，失败或没有新数据也记录，避免重复请求"""
+        db_session = self.Session()
+        try:
+            now = datetime.utcnow()
+            db_session.execute(insert(TrendSeries.__table__).values(
+                country=country, brand=brand, model=model, trend=trend, last_fetched_at=now
+            ).on_conflict_do_update(
+                index_elements=['country', 'brand', 'model', 'trend'],
+                set_={'last_fetched_at': now},
+            ))
+            db_session.commit()
+        except Exception as e:
+            db_session.rollback()
+            logging.error(f"Failed to record trend fetch: {str(e)}")
+        finally:
+            db_session.close()
+
+    def save_series(self, country, brand, model, trend, data):
+        """写入远程返回的序列，返回写入天数；今天的数据尚不完整，不保存，重复的日期用新值覆盖"""
+        now = datetime.utcnow()
+        today = date.today()
+        rows = []
+        for x, y in zip(data.get("x", []), data.get("y", [])):
+            try:
+                day = _parse_day(x)
+            except ValueError:
+                logging.warning(f"Skipping non-date trend point: {x}")
+                continue
+            if day >= today:
+                continue
+            rows.append({'country': country, 'brand': brand, 'model': model, 'trend': trend,
+                         'date': day, 'value': y, 'fetched_at': now})
+
+        if not rows:
+            return 0
+
+        db_session = self.Session()
+        try:
+            stmt = insert(TrendSnapshot.__table__)
+            result = db_session.execute(stmt.on_conflict_do_update(
+                index_elements=['country', 'brand', 'model', 'trend', 'date'],
+                set_={'value': stmt.excluded.value, 'fetched_at': stmt.excluded.fetched_at},
+            ), rows)
+            saved = max(result.rowcount, 0)
+            db_session.commit()
+            logging.info(f"Saved {saved} days for {country}-{brand}-{model}-{trend}")
+            return saved
+        except Exception as e:
+            db_session.rollback()
+            logging.error(f"Failed to save trend snapshot: {str(e)}")
+            return 0
+        finally:
+            db_session.close()
+
+    def store_remote(self, country, brand, model, trend, data):
+        """保存一次远程请求的结果，返回写入天数"""
+        self.record_fetch(country, brand, model, trend)
+        if data is None:
+            return 0
+        return self.save_series(country, brand, model, trend, data)
+
+    def get_or_fetch(self, country, brand, model, trend, fetch_remote):
+        """只在本地缺少天数时调用 fetch_remote(start_date)，之后从本地读取"""
+        since = self.missing_since(country, brand, model, trend)
+        if since is not False:
+            data = fetch_remote(since)
+            if self.store_remote(country, brand, model, trend, data) == 0 and since is None:
+                # 本地没有可保存的完整日期（如错误占位数据或只有今天的数据），直接返回远程数据
+                return data
+        series = self.get_series(country, brand, model, trend)
+        if not series["x"]:
+            return {"x": ["暂无数据"], "y": [0]}
+        return series
+
+    def rolling_average(self, country, brand, model, trend, window=7, start=None, end=None):
+        """按日期的滑动平均，窗口为最近 window 天"""
+        sql = """
+            SELECT a.date, a.value, AVG(b.value) AS rolling
+            FROM trend_snapshots a
+            JOIN trend_snapshots b
+              ON b.country = a.country AND b.brand = a.brand AND b.model = a.model AND b.trend = a.trend
+             AND b.date BETWEEN date(a.date, :offset) AND a.date
+            WHERE a.country = :country AND a.brand = :brand AND a.model = :model AND a.trend = :trend
+              AND (:start IS NULL OR a.date >= :start) AND (:end IS NULL OR a.date <= :end)
+            GROUP BY a.date, a.value
+            ORDER BY a.date
+        """
+        with self.engine.connect() as conn:
+            rows = conn.execute(text(sql), {
+                'country': country, 'brand': brand, 'model': model, 'trend': trend,
+                'offset': f'-{window - 1} day',
+                'start': start.isoformat() if start else None,
+                'end': end.isoformat() if end else None,
+            }).all()
+        return {"x": [str(r.date) for r in rows], "y": [r.value for r in rows],
+                "rolling": [r.rolling for r in rows]}
+
+    def week_over_week(self, country, brand, model, trend, start=None, end=None):
+        """与7天前同一天相比的变化量和变化率，缺少7天前数据时为 None"""
+        sql = """
+            SELECT a.date, a.value, b.value AS prev_value
+            FROM trend_snapshots a
+            LEFT JOIN trend_snapshots b
+              ON b.country = a.country AND b.brand = a.brand AND b.model = a.model AND b.trend = a.trend
+             AND b.date = date(a.date, '-7 day')
+            WHERE a.country = :country AND a.brand = :brand AND a.model = :model AND a.trend = :trend
+              AND (:start IS NULL OR a.date >= :start) AND (:end IS NULL OR a.date <= :end)
+            ORDER BY a.date
+        """
+        with self.engine.connect() as conn:
+            rows = conn.execute(text(sql), {
+                'country': country, 'brand': brand, 'model': model, 'trend': trend,
+                'start': start.isoformat() if start else None,
+                'end': end.isoformat() if end else None,
+            }).all()
+        delta, pct = [], []
+        for r in rows:
+            if r.value is None or r.prev_value is None:
+                delta.append(None)
+                pct.append(None)
+            else:
+                delta.append(r.value - r.prev_value)
+                pct.append((r.value - r.prev_value) / r.prev_value * 100 if r.prev_value else None)
+        return {"x": [str(r.date) for r in rows], "y": [r.value for r in rows], "delta": delta, "pct": pct}
+
+    def compare_models(self, country, brand, trend, models=None, start=None, end=None):
+        """跨车型查询，返回 {车型: {"x": [...], "y": [...]}}；models 为空时返回该品牌所有车型"""
+        sql = """
+            SELECT model, date, value FROM trend_snapshots
+            WHERE country = :country AND trend = :trend AND brand = :brand
+              AND (:start IS NULL OR date >= :start) AND (:end IS NULL OR date <= :end)
+        """
+        params = {
+            'country': country, 'brand': brand, 'trend': trend,
+            'start': start.isoformat() if start else None,
+            'end': end.isoformat() if end else None,
+        }
+        stmt = text(sql + " ORDER BY model, date")
+        if models:
+            stmt = text(sql + " AND model IN :models ORDER BY model, date").bindparams(
+                bindparam('models', expanding=True))
+            params['models'] = list(models)
+        with self.engine.connect() as conn:
+            rows = conn.execute(stmt, params).all()
+        result = {}
+        for r in rows:
+            series = result.setdefault(r.model, {"x": [], "y": []})
+            series["x"].append(str(r.date))
+            series["y"].append(r.value)
+        return result
+
+    def price_percentiles(self, country, brand, model=None, percentiles=(25, 50, 75),
+                          trend="车型-平均价格-时间", start=None, end=None):
+        """平均价格序列的分位数；model 为空时统计该品牌所有车型"""
+        sql = """
+            SELECT value FROM trend_snapshots
+            WHERE country = :country AND trend = :trend AND brand = :brand
+              AND (:model IS NULL OR model = :model) AND value IS NOT NULL
+              AND (:start IS NULL OR date >= :start) AND (:end IS NULL OR date <= :end)
+        """
+        with self.engine.connect() as conn:
+            values = conn.execute(text(sql), {
+                'country': country, 'brand': brand, 'model': model, 'trend': trend,
+                'start': start.isoformat() if start else None,
+                'end': end.isoformat() if end else None,
+            }).scalars().all()
+        if not values:
+            return {}
+        if len(values) == 1:
+            return {p: values[0] for p in percentiles}
+        cuts = statistics.quantiles(values, n=100, method='inclusive')
+        cuts = [min(values)] + cuts + [max(values)]
+        return {p: cuts[p] for p in percentiles}
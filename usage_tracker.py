@@ -0,0 +1,221 @@
+import atexit
+import logging
+import threading
+from datetime import datetime
+from sqlalchemy import bindparam, func, select
+from models import User, get_db_session
+
+# 配置日志
+logging.basicConfig(level=logging.INFO, format="%(asctime)s - %(levelname)s - %(message)s")
+
+# 批量写入配置：每隔 FLUSH_INTERVAL 秒或累计 FLUSH_THRESHOLD 次查询写一次库
+FLUSH_INTERVAL = 5.0
+FLUSH_THRESHOLD = 200
+
+# 一条 UPDATE 语句，通过 executemany 在同一个事务里更新所有用户
+_usage_update = (
+    User.__table__.update()
+    .where(User.__table__.c.email == bindparam('b_email'))
+    .values(
+        usage_count=User.__table__.c.usage_count + bindparam('b_increment'),
+        last_used_ip=func.coalesce(bindparam('b_ip'), User.__table__.c.last_used_ip),
+        updated_at=bindparam('b_updated_at'),
+    )
+)
+
+
+class UsageTracker:
+    """在内存中累计每个用户的查询次数和最后IP，定期批量写回 users 表
+
+    每次写库后会重新读取本次写入用户的 usage_count，未写入的用户缓存直接丢弃，
+    所以内存中的计数最多落后数据库一个写库周期。多进程部署（gunicorn/uwsgi 多个 worker）时
+    每个进程各自累计，两次写库之间其他进程的查询不可见。
+
+    本地 users 表中没有的用户（通过远程 /api/register 注册）无法写库，只在 _local_only 中计数，
+    写库不会清空，进程重启后从 0 开始；这类用户的额度以远程 /api/query 为准。
+    """
+
+    def __init__(self, session_factory=get_db_session, flush_interval=FLUSH_INTERVAL,
+                 flush_threshold=FLUSH_THRESHOLD):
+        self.session_factory = session_factory
+        self.flush_interval = flush_interval
+        self.flush_threshold = flush_threshold
+        self._lock = threading.Lock()
+        self._flush_lock = threading.Lock()
+        self._persisted = {}   # email -> 已落库的 usage_count
+        self._pending = {}     # email -> [增量, 最后IP]
+        self._inflight = {}    # 正在写库、尚未确认的增量
+        self._local_only = {}  # email -> 查询次数，本地 users 表中没有的用户
+        self._pending_events = 0
+        self._epoch = 0        # 每次写库结束加一，用于丢弃写库期间读到的旧值
+        self._wakeup = threading.Event()
+        self._stopped = threading.Event()
+        self._thread = threading.Thread(target=self._run, name="usage-flusher", daemon=True)
+        self._thread.start()
+
+    def record_query(self, email, ip=None):
+        """记录一次查询，返回记录后的查询次数"""
+        while True:
+            self._ensure_loaded(email)
+            with self._lock:
+                if email not in self._persisted and email not in self._local_only:
+                    continue
+                self._add_pending(email, ip)
+                return self._current_count(email)
+
+    def get_usage_count(self, email):
+        """获取查询次数（已落库 + 正在写库 + 尚未写入的增量）"""
+        while True:
+            self._ensure_loaded(email)
+            with self._lock:
+                if email not in self._persisted and email not in self._local_only:
+                    continue
+                return self._current_count(email)
+
+    def try_consume(self, email, limit, ip=None):
+        """额度未用完时记录一次查询并返回 True，否则返回 False"""
+        while True:
+            self._ensure_loaded(email)
+            with self._lock:
+                if email not in self._persisted and email not in self._local_only:
+                    continue
+                if self._current_count(email) >= limit:
+                    return False
+                self._add_pending(email, ip)
+                return True
+
+    def flush(self):
+        """把累计的增量一次性写入数据库，返回更新的用户数"""
+        with self._flush_lock:
+            with self._lock:
+                self._inflight, self._pending = self._pending, {}
+                self._pending_events = 0
+                batch = self._inflight
+
+            if not batch:
+                # 没有待写入的增量，只丢弃缓存，下次访问时重新读取
+                with self._lock:
+                    self._persisted = {}
+                    self._epoch += 1
+                return 0
+
+            # 写库和重新读取在锁外进行，不阻塞查询
+            now = datetime.utcnow()
+            params = [
+                {'b_email': email, 'b_increment': increment, 'b_ip': ip, 'b_updated_at': now}
+                for email, (increment, ip) in batch.items()
+            ]
+            db_session = self.session_factory()
+            try:
+                db_session.execute(_usage_update, params)
+                fresh = dict(db_session.execute(
+                    select(User.__table__.c.email, User.__table__.c.usage_count)
+                    .where(User.__table__.c.email.in_(list(batch)))
+                ).all())
+                db_session.commit()
+            except Exception as e:
+                db_session.rollback()
+                logging.error(f"批量更新查询次数失败: {str(e)}")
+                # 写库失败时把增量放回待写队列，下次重试
+                with self._lock:
+                    for email, (increment, ip) in batch.items():
+                        entry = self._pending.setdefault(email, [0, None])
+                        entry[0] += increment
+                        if entry[1] is None:
+                            entry[1] = ip
+                        self._pending_events += increment
+                    self._inflight = {}
+                return 0
+            finally:
+                db_session.close()
+
+            with self._lock:
+                persisted = {}
+                for email, (increment, _) in batch.items():
+                    if email in fresh:
+                        persisted[email] = fresh[email] or 0
+                    else:
+                        # 写库期间用户从 users 表中消失，改为只在内存中计数
+                        self._local_only[email] = (self._persisted.get(email, 0) + increment
+                                                  + self._pending.pop(email, [0, None])[0])
+                self._persisted = persisted
+                self._inflight = {}
+                self._epoch += 1
+            logging.info(f"批量更新查询次数: {len(params)} 个用户")
+            return len(params)
+
+    def close(self):
+        """停止后台线程并写入剩余的增量"""
+        if self._stopped.is_set():
+            return
+        self._stopped.set()
+        self._wakeup.set()
+        self._thread.join()
+        self.flush()
+
+    def _run(self):
+        while not self._stopped.is_set():
+            self._wakeup.wait(self.flush_interval)
+            self._wakeup.clear()
+            if self._stopped.is_set():
+                break
+            try:
+                self.flush()
+            except Exception as e:
+                logging.error(f"后台写入查询次数失败: {str(e)}")
+
+    def _add_pending(self, email, ip):
+        # 调用方需持有 self._lock
+        if email in self._local_only:
+            self._local_only[email] += 1
+            return
+        entry = self._pending.setdefault(email, [0, None])
+        entry[0] += 1
+        if ip:
+            entry[1] = ip
+        self._pending_events += 1
+        if self._pending_events >= self.flush_threshold:
+            self._wakeup.set()
+
+    def _current_count(self, email):
+        # 调用方需持有 self._lock
+        if email in self._local_only:
+            return self._local_only[email]
+        return (self._persisted[email]
+                + self._inflight.get(email, [0, None])[0]
+                + self._pending.get(email, [0, None])[0])
+
+    def _ensure_loaded(self, email):
+        # 在锁外读取数据库；读取期间如果发生过写库，读到的值可能已过期，丢弃后重读
+        while True:
+            with self._lock:
+                if email in self._persisted or email in self._local_only:
+                    return
+                epoch = self._epoch
+            db_session = self.session_factory()
+            try:
+                user = db_session.query(User).filter_by(email=email).first()
+                count = (user.usage_count or 0) if user else None
+            finally:
+                db_session.close()
+            with self._lock:
+                if count is None:
+                    self._local_only.setdefault(email, 0)
+                    return
+                if self._epoch == epoch:
+                    self._persisted.setdefault(email, count)
+                    return
+
+
+_tracker = None
+_tracker_lock = threading.Lock()
+
+
+def get_usage_tracker():
+    """获取进程内共享的 UsageTracker，进程退出时自动写入剩余增量"""
+    global _tracker
+    with _tracker_lock:
+        if _tracker is None:
+            _tracker = UsageTracker()
+            atexit.register(_tracker.close)
+        return _tracker